@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+""" Benchmarks for the input, output and unicode_csv paths.
+
+    Generates synthetic csv files (of a given size, width, encoding, density
+    of fields needing quoting and ratio of duplicate keys), times each entry
+    point on them, and reports rows/s, bytes/s and peak memory. Results can
+    be saved as a baseline, and later runs compared against it to catch
+    regressions. Each benchmark runs in it's own process, so peak memory is
+    it's own.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+
+from argparse_ import ArgumentParser
+import unicode_csv
+import input as input_
+import output
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+log = logging.getLogger(__name__)
+
+# Text fields; the non-ASCII ones are only used if the encoding allows.
+words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta']
+unicode_words = [u'na\xefve', u'caf\xe9', u'\u20acuro', u'\u03a9mega',
+                 u'stra\xdfe']
+# Fields that need quoting.
+quoted_words = ['with, comma', 'with "quotes"', 'multi\nline']
+
+
+def dataset(directory, rows=100000, width=8, encoding='utf-8', quoting=0.1,
+            duplicates=0.1, seed=0):
+    """ Returns the path of a synthetic csv file in 'directory', generating
+        it if it doesn't already exist.
+
+        It has a header, and 'rows' rows of 'width' columns: a key column
+        ('duplicates' of the keys repeat earlier ones), then int, float and
+        text columns in turn. 'quoting' of the text fields need quoting.
+    """
+    name = 'bench-{0}x{1}-{2}-q{3}-d{4}-s{5}.csv'.format(
+                rows, width, encoding, quoting, duplicates, seed)
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return path
+    log.info("Generating '{0}'.".format(path))
+    rand = random.Random(seed)
+    text = list(words)
+    try:
+        u''.join(unicode_words).encode(encoding)
+        text.extend(unicode_words)
+    except UnicodeError:
+        pass
+    header = ['key'] + ['{0}{1}'.format(('int', 'float', 'text')[j % 3], j)
+                        for j in range(width - 1)]
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fl:
+        writer = unicode_csv.UnicodeWriter(fl, encoding=encoding,
+                                           lineterminator='\n',
+                                           buffer_size=1 << 16)
+        writer.writerow(header)
+        for i in xrange(rows):
+            key = i
+            if i and rand.random() < duplicates:
+                key = rand.randrange(i)
+            row = ['k{0}'.format(key)]
+            for j in range(width - 1):
+                kind = j % 3
+                if kind == 0:
+                    row.append(unicode(rand.randint(-10000, 10000)))
+                elif kind == 1:
+                    row.append(unicode(round(rand.uniform(-1e3, 1e3), 3)))
+                elif rand.random() < quoting:
+                    row.append(unicode(rand.choice(quoted_words)))
+                else:
+                    row.append(rand.choice(text))
+            writer.writerow(row)
+        writer.flush()
+    os.rename(tmp, path)
+    return path
+
+
+def _input_kwargs(opts):
+    """ Returns the kwargs to read the dataset with the input functions.
+    """
+    kwargs = {'encoding': opts['encoding']}
+    if u','.encode(opts['encoding']) != ',':
+        # The sniffer only handles ASCII compatible encodings.
+        kwargs.update(dialect='excel', has_header=True)
+    return kwargs
+
+
+# Benchmarks, each called with the dataset path and options after any setup
+# that shouldn't be timed, returns a function to time which returns the
+# (rows, bytes) it processed.
+
+def bench_csv2list(path, opts):
+    size = os.path.getsize(path)
+    kwargs = _input_kwargs(opts)
+    return lambda: (len(input_.csv2list(path, **kwargs)), size)
+
+def bench_csv2dict(path, opts):
+    size = os.path.getsize(path)
+    kwargs = _input_kwargs(opts)
+    def run():
+        rows = input_.csv2dict(path, list_values='always', **kwargs)
+        return sum(len(v) for v in rows.itervalues()), size
+    return run
+
+def bench_UnicodeReader(path, opts):
+    size = os.path.getsize(path)
+    def run():
+        with open(path, 'rb') as fl:
+            reader = unicode_csv.UnicodeReader(fl, encoding=opts['encoding'])
+            return sum(1 for row in reader), size
+    return run
+
+def bench_UnicodeWriter(path, opts):
+    rows = input_.csv2list(path, **_input_kwargs(opts))
+    out = os.path.join(opts['dir'], 'bench-writer.csv')
+    def run():
+        with open(out, 'wb') as fl:
+            writer = unicode_csv.UnicodeWriter(fl, encoding=opts['encoding'],
+                                               buffer_size=1 << 16)
+            writer.writerows(rows)
+            writer.flush()
+        return len(rows), os.path.getsize(out)
+    return run
+
+def bench_OutputCsv(path, opts):
+    rows = input_.csv2list(path, **_input_kwargs(opts))
+    name = os.path.join(opts['dir'], 'bench-output')
+    def run():
+        output.table(rows, name, ('csv',))
+        return len(rows), os.path.getsize(name + '.csv')
+    return run
+
+def bench_repr2Dof2D(path, opts):
+    # A grid of 8 x 8 numeric blocks, one inner row per dataset row.
+    rand = random.Random(opts['seed'])
+    block_rows = max(opts['rows'] // 64, 1)
+    cols = opts['width']
+    if numpy:
+        state = numpy.random.RandomState(opts['seed'])
+        block = lambda: state.uniform(-1e3, 1e3, (block_rows, cols))
+    else:
+        block = lambda: [[rand.uniform(-1e3, 1e3) for _ in range(cols)]
+                         for _ in range(block_rows)]
+    table = [[block() for _ in range(8)] for _ in range(8)]
+    def run():
+        return block_rows * 64, len(output.repr2Dof2D(table))
+    return run
+
+benchmarks = dict((name[len('bench_'):], bench)
+                  for name, bench in globals().items()
+                  if name.startswith('bench_'))
+
+
+def _peak_rss():
+    """ Returns the peak resident memory of this process, in KiB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (Linux gives KiB, OS X bytes.)
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(name, path, opts):
+    """ Runs benchmark 'name' on 'path' (in this process), returns a dict of
+        the results.
+    """
+    run = benchmarks[name](path, opts)
+    setup_rss = _peak_rss()
+    best = None
+    for _ in range(opts['repeat']):
+        start = time.time()
+        rows, size = run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    best = max(best, 1e-9)
+    return {'seconds': best,
+            'rows': rows,
+            'bytes': size,
+            'rows_per_sec': rows / best,
+            'bytes_per_sec': size / best,
+            'peak_rss_kb': _peak_rss(),
+            'run_rss_kb': _peak_rss() - setup_rss}
+
+
+def run_all(names, opts):
+    """ Runs the 'names' benchmarks, each in a new process, returns the
+        results dict (with the options and platform under 'meta').
+    """
+    spec = dict((k, opts[k]) for k in ('rows', 'width', 'encoding',
+                                       'quoting', 'duplicates', 'seed'))
+    path = dataset(opts['dir'], **spec)
+    results = {'meta': dict(spec, repeat=opts['repeat'],
+                            python=platform.python_version(),
+                            platform=platform.platform(),
+                            numpy=numpy is not None)}
+    for name in names:
+        log.info("Running '{0}'.".format(name))
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--child', name, path, json.dumps(opts)],
+                                 stdout=subprocess.PIPE)
+        out = child.communicate()[0]
+        if child.returncode:
+            raise RuntimeError("Benchmark '{0}' failed.".format(name))
+        results[name] = json.loads(out)
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """ Returns a list of messages for benchmarks that are more than
+        'threshold' (a fraction) slower, or use more memory, than in
+        'baseline'.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if name == 'meta' or not base:
+            continue
+        if result['rows_per_sec'] < base['rows_per_sec'] * (1 - threshold):
+            regressions.append("{0}: {1:.0f} rows/s, was {2:.0f}.".format(
+                        name, result['rows_per_sec'], base['rows_per_sec']))
+        if result['run_rss_kb'] > max(base['run_rss_kb'], 1024) * (
+                1 + threshold):
+            regressions.append("{0}: {1} KiB peak, was {2}.".format(
+                        name, result['run_rss_kb'], base['run_rss_kb']))
+    if baseline.get('meta', {}) != results.get('meta', {}):
+        log.warning("Baseline was run with different options or platform.")
+    return regressions
+
+
+def report(results, baseline=None):
+    """ Returns a table of the results (and the change from 'baseline').
+    """
+    lines = ["{0:<15} {1:>12} {2:>12} {3:>12} {4:>8}".format(
+                'benchmark', 'rows/s', 'MiB/s', 'peak KiB', 'change')]
+    for name, result in sorted(results.iteritems()):
+        if name == 'meta':
+            continue
+        change = ''
+        if baseline and name in baseline:
+            change = '{0:+.1%}'.format(result['rows_per_sec'] /
+                                       baseline[name]['rows_per_sec'] - 1)
+        lines.append("{0:<15} {1:>12.0f} {2:>12.2f} {3:>12} {4:>8}".format(
+                        name, result['rows_per_sec'],
+                        result['bytes_per_sec'] / (1 << 20),
+                        result['run_rss_kb'], change))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+            help="Benchmarks to run (default all): {0}."
+                    .format(', '.join(sorted(benchmarks))))
+    parser.add_argument('--rows', type=int, default=100000,
+            help="Rows in the dataset [%(default)s].")
+    parser.add_argument('--width', type=int, default=8,
+            help="Columns in the dataset [%(default)s].")
+    parser.add_argument('--encoding', default='utf-8',
+            help="Encoding of the dataset [%(default)s].")
+    parser.add_argument('--quoting', type=float, default=0.1,
+            help="Fraction of text fields needing quotes [%(default)s].")
+    parser.add_argument('--duplicates', type=float, default=0.1,
+            help="Fraction of rows with a duplicate key [%(default)s].")
+    parser.add_argument('--seed', type=int, default=0,
+            help="Random seed for the dataset [%(default)s].")
+    parser.add_argument('--repeat', type=int, default=3,
+            help="Runs of each benchmark, the best is kept [%(default)s].")
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(),
+                                                      'python_misc_bench'),
+            help="Directory for the datasets and outputs [%(default)s].")
+    parser.add_argument('-s', '--save', metavar='FILE',
+            help="Save the results as JSON to FILE.")
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+            help="Compare against the JSON results in FILE, exiting with 1 "
+                 "if there are regressions.")
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+            help="Fractional slowdown (or memory increase) counted as a "
+                 "regression [%(default)s].")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level or logging.WARNING)
+    unknown = set(args.benchmarks) - set(benchmarks)
+    if unknown:
+        parser.error("Unknown benchmarks: {0}.".format(', '.join(unknown)))
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    opts = dict((k, getattr(args, k)) for k in ('rows', 'width', 'encoding',
+                                                'quoting', 'duplicates',
+                                                'seed', 'repeat', 'dir'))
+    results = run_all(args.benchmarks or sorted(benchmarks), opts)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fl:
+            baseline = json.load(fl)
+    print report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as fl:
+            json.dump(results, fl, indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print "Regression:", regression
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        name, path, opts = sys.argv[2:5]
+        json.dump(measure(name, path, json.loads(opts)), sys.stdout)
+        sys.exit(0)
+    sys.exit(main())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+""" Simple persistent caches.
+"""
+
+import os
+import sys
+import time
+import zlib
+import marshal
+import logging
+import hashlib
+import tempfile
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+
+class DiskCache(object):
+    """ On-disk cache of byte strings, keyed on anything with a stable repr.
+
+        Each entry is a file in the 'path' directory. Entries are evicted
+        least recently used first (by file modification time, which is updated
+        on every hit) once the total size is over 'max_size' bytes, down to
+        'low_water' of it. The total is kept as entries are written, so the
+        directory is only scanned when it looks to be over (and the total
+        then corrected for any other writers).
+    """
+    def __init__(self, path=None, max_size=1 << 30, low_water=0.9):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache',
+                                'python_misc')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+        # Total size of the entries, or None until it's first needed.
+        self.size = None
+
+    @staticmethod
+    def key(*parts):
+        """ Makes a key (a hex digest) from the repr of 'parts'.
+        """
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, default=None):
+        """ Returns the data stored for 'key', or 'default' if there's none.
+        """
+        fl = self._file(key)
+        try:
+            with open(fl, 'rb') as cache_file:
+                data = cache_file.read()
+            os.utime(fl, None)
+        except (IOError, OSError):
+            return default
+        log.debug("Cache hit for {0}.".format(key))
+        return data
+
+    def set(self, key, data):
+        """ Stores 'data' for 'key', evicting old entries to make space.
+        """
+        if self.size is None:
+            self.evict()
+        fl = self._file(key)
+        old_size = self._size(fl)
+        # Write to a temporary file and rename, so readers never see partial
+        # entries.
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(data)
+            os.rename(tmp, fl)
+        except (IOError, OSError):
+            log.warning("Couldn't write cache entry {0}.".format(key))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.size += len(data) - old_size
+        if self.size > self.max_size:
+            self.evict()
+
+    @staticmethod
+    def _size(fl):
+        try:
+            return os.path.getsize(fl)
+        except OSError:
+            return 0
+
+    def delete(self, key):
+        """ Removes the entry for 'key', if there is one.
+        """
+        fl = self._file(key)
+        size = self._size(fl)
+        try:
+            os.remove(fl)
+        except OSError:
+            return
+        if self.size is not None:
+            self.size -= size
+
+    def evict(self):
+        """ Finds the total size of the cache, and if it's over 'max_size'
+            removes least recently used entries until it's within
+            'low_water' of it.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.tmp'):
+                continue
+            try:
+                st = os.stat(self._file(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        self.size = sum(size for mtime, size, name in entries)
+        if self.size <= self.max_size:
+            return
+        target = self.max_size * self.low_water
+        for mtime, size, name in sorted(entries):
+            if self.size <= target:
+                break
+            log.debug("Evicting cache entry {0}.".format(name))
+            self.delete(name)
+
+
+CachedResponse = namedtuple('CachedResponse', ('url', 'status', 'headers',
+                                               'body', 'stored'))
+
+
+class CacheMiss(IOError):
+    """ Raised for a URL that isn't cached when the cache is offline.
+    """
+
+
+class ResponseCache(object):
+    """ HTTP response cache, storing bodies zlib compressed in a DiskCache
+        (which bounds its size).
+
+        Responses are served from the cache for 'ttl' seconds, after which
+        they're revalidated with If-None-Match/If-Modified-Since if they had
+        an ETag or Last-Modified header (and dropped if not). If 'offline'
+        only cached responses are served (however old), and anything else
+        raises a CacheMiss.
+    """
+    def __init__(self, cache=None, ttl=3600, offline=False):
+        self.cache = DiskCache() if cache is None else cache
+        self.ttl = ttl
+        self.offline = offline
+
+    # Request headers that say who's asking, so must be part of keys.
+    identity_headers = ('authorization', 'cookie', 'proxy-authorization')
+
+    def key(self, url, *state):
+        """ Makes the key for 'url' (and any form data, auth, etc. 'state').
+        """
+        return self.cache.key('http', url, state)
+
+    def identity(self, headers):
+        """ Returns the 'identity_headers' of request 'headers' (a dict), as
+            key state.
+        """
+        return tuple(sorted((k.lower(), v) for k, v in headers.iteritems()
+                            if k.lower() in self.identity_headers))
+
+    def get(self, key):
+        """ Returns the CachedResponse for 'key', or None.
+        """
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        try:
+            url, status, headers, body, stored = marshal.loads(data)
+            return CachedResponse(url, status, headers, zlib.decompress(body),
+                                  stored)
+        except (ValueError, EOFError, TypeError, zlib.error):
+            log.warning("Dropping bad cache entry {0}.".format(key))
+            self.cache.delete(key)
+            return None
+
+    def set(self, key, url, status, headers, body, stored=None):
+        """ Stores a response, returns its CachedResponse.
+        """
+        entry = CachedResponse(url, status, dict(headers), body,
+                               time.time() if stored is None else stored)
+        self.cache.set(key, marshal.dumps(tuple(entry._replace(
+                                    body=zlib.compress(body)))))
+        return entry
+
+    @staticmethod
+    def validators(entry):
+        """ Returns the conditional request headers for revalidating 'entry'.
+        """
+        headers = {}
+        for name, header in (('etag', 'If-None-Match'),
+                             ('last-modified', 'If-Modified-Since')):
+            for k, v in entry.headers.iteritems():
+                if k.lower() == name:
+                    headers[header] = v
+        return headers
+
+    def fetch(self, key, url, request):
+        """ Returns the CachedResponse for 'url', only calling
+            'request(headers)' (which returns (status, headers, body), with
+            a 304 status if the conditional 'headers' hold) if there's no
+            fresh cached response.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            if self.offline or time.time() - entry.stored < self.ttl:
+                return entry
+            validators = self.validators(entry)
+            if not validators:
+                self.cache.delete(key)
+                entry = None
+        elif self.offline:
+            raise CacheMiss("{0} isn't cached.".format(url))
+        status, headers, body = request(validators if entry else {})
+        if status == 304 and entry is not None:
+            log.debug("Revalidated {0}.".format(url))
+            return self.set(key, entry.url, entry.status, entry.headers,
+                            entry.body)
+        if status == 200:
+            return self.set(key, url, status, headers, body)
+        return CachedResponse(url, status, dict(headers), body, time.time())
+
+
+if __name__ == '__main__':
+    sys.stderr.write('\n'.join((__doc__, 'import only.', '')))
+    sys.exit(1)
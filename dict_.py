@@ -1,48 +1,166 @@
 """ Dictionary helper functions.
 """
 
+import operator
+import itertools
 import collections
 
 
+def truthy(old, new):
+    """ Precedence policy: update with true values, or with false (but not
+        'None') values over false ones.
+    """
+    return new or (new is not None and not old)
+
+def allow_false(old, new):
+    """ Precedence policy: update with any value other than 'None'.
+    """
+    return new is not None
+
+def always(old, new):
+    """ Precedence policy: always update.
+    """
+    return True
+
+def fill(old, new):
+    """ Precedence policy: only update missing (or 'None') values.
+    """
+    return old is None and new is not None
+
+policies = {
+        'truthy': truthy,
+        'allow_false': allow_false,
+        'always': always,
+        'fill': fill,
+    }
+
+def merge_all(base, *layers, **kwds):
+    """ Function to update the dictionary 'base' with each of 'layers' in
+        turn (mappings or iterables of pairs), recursively merging nested
+        dicts. Other values (including a dict over a non-dict) are only
+        updated if the 'policy' (a function of the old value, or 'None',
+        and the new one, or the name of one in 'policies') says so. Returns
+        'base'.
+        The hierachy is walked with an explicit stack (so there's no limit
+        on its depth). If 'copy' is true, no dict passed in is
+        modified; dicts are copied as they're updated (so the result may
+        share unchanged dicts with 'base' and 'layers').
+    """
+    policy = kwds.pop('policy', truthy)
+    copy = kwds.pop('copy', False)
+    if kwds:
+        raise TypeError("Unexpected keyword arguments: {0}."
+                            .format(', '.join(kwds)))
+    if not callable(policy):
+        policy = policies[policy]
+    # 'truthy' is checked inline, as it's the common case
+    inline = policy is truthy
+    # ids of the dicts copied (so safe to modify)
+    owned = set()
+    if copy:
+        base = base.copy()
+        owned.add(id(base))
+    # (dict, source) pairs to merge; nested dicts are merged as they're
+    # found, depth first, so layers apply in turn just as if merged one by
+    # one.
+    stack = [(base, u) for u in reversed(layers)]
+    while stack:
+        d, u = stack.pop()
+        children = None
+        for k, v in (u.iteritems() if hasattr(u, 'iteritems') else u):
+            if v:
+                if isinstance(v, dict):
+                    child = d.get(k)
+                    if isinstance(child, dict):
+                        if copy and id(child) not in owned:
+                            child = d[k] = child.copy()
+                            owned.add(id(child))
+                        if children is None:
+                            children = [(child, v)]
+                        else:
+                            children.append((child, v))
+                        continue
+                    # Replacing a non-dict with a dict is up to the policy.
+                    if not inline and not policy(child, v):
+                        continue
+                elif not inline and not policy(d.get(k), v):
+                    continue
+            elif inline:
+                if v is None or d.get(k):
+                    continue
+            elif not policy(d.get(k), v):
+                continue
+            d[k] = v
+        if children:
+            children.reverse()
+            stack.extend(children)
+    return base
+
 def safe_update(d, u, allow_false=False, **kwargs):
     """ Function to recursively update a dictionary, overwriting only if key 
         values have a higher precedence (depending on whether value is 'True' 
         and whether we 'allow_false' updates. Will never update with a value 
         of 'None'
     """
-    # process u
-    if hasattr(u, 'iteritems'):
-        t = u.iteritems()
-    else:
-        t = u
-    for k, v in t:
-        if v and isinstance(v, dict):
-            if isinstance(d.get(k), dict):
-                safe_update(d[k], v, allow_false=allow_false)
-            else:
-                d[k] = v
-        elif ((allow_false and v != None) or v or 
-                (v != None and not d.get(k))):
-            d[k] = v
-    # process kwargs
-    for k, v in kwargs.iteritems():
-        if v and isinstance(v, dict):
-            if isinstance(d.get(k), dict):
-                safe_update(d[k], v, allow_false=allow_false)
-            else:
-                d[k] = v
-        elif ((allow_false and v != None) or v or 
-                (v != None and not d.get(k))):
-            d[k] = v
+    merge_all(d, u, kwargs,
+              policy='allow_false' if allow_false else 'truthy')
+
+def iter_paths(d):
+    """ Generates (path, value) pairs for the leaves (non-dict values) of a
+        dict hierachy, where path is the tuple of keys to the value. Walks
+        depth first with an explicit stack, so doesn't recurse.
+    """
+    stack = [((), d.iteritems())]
+    while stack:
+        path, items = stack[-1]
+        for k, v in items:
+            if isinstance(v, dict):
+                stack.append((path + (k,), v.iteritems()))
+                break
+            yield path + (k,), v
+        else:
+            stack.pop()
+
+def iter_leaves(d):
+    """ Generates the leaves (non-dict values) of a dict hierachy, in the
+        same order as iter_paths.
+    """
+    stack = [d.itervalues()]
+    while stack:
+        for v in stack[-1]:
+            if isinstance(v, dict):
+                stack.append(v.itervalues())
+                break
+            yield v
+        else:
+            stack.pop()
+
+def prune(d, test, empty=True):
+    """ Function to remove leaves from a dict hierachy (in place) using test
+        function, and then (if 'empty') any dicts left empty. Returns 'd'.
+    """
+    # (dict, its items, its key in the parent, keys to remove)
+    stack = [(d, d.iteritems(), None, [])]
+    while stack:
+        node, items, key, remove = stack[-1]
+        for k, v in items:
+            if isinstance(v, dict):
+                stack.append((v, v.iteritems(), k, []))
+                break
+            if test(v):
+                remove.append(k)
+        else:
+            stack.pop()
+            for k in remove:
+                del node[k]
+            if empty and not node and stack:
+                stack[-1][3].append(key)
+    return d
 
 def strip(d):
     """ Function to recursively remove 'None' values from a dictionary.
     """
-    for k, v in d.items():
-        if isinstance(v, dict):
-            strip(d[k])
-        elif v == None:
-            del d[k]
+    prune(d, lambda v: v is None, empty=False)
 
 def split(d):
     """ Function separate a dict's values that are dicts themselves. Removes 
@@ -52,7 +170,7 @@ def split(d):
     for k, v in d.items():
         if isinstance(v, dict):
             t = d.pop(k)
-            strip_dict(t)
+            strip(t)
             if t:
                 g[k] = t
         elif v == None:
@@ -60,44 +178,104 @@ def split(d):
     return d, g
 
 def insert(parent, child, *args):
-    """ Recursively inserts an element into a dictionary hierachy.
+    """ Inserts an element into a dictionary hierachy.
         Called as insert(dict, key_1, key_2, ..., key_n, val)
     """
-    if len(args) > 1:
-        if not isinstance(parent.get(child), dict):
-            parent[child] = {}
-        insert(parent[child], *args)
-    else:
-        parent[child] = args[0]
+    keys = (child,) + args[:-1]
+    for key in keys[:-1]:
+        if not isinstance(parent.get(key), dict):
+            parent[key] = {}
+        parent = parent[key]
+    parent[keys[-1]] = args[-1]
 
-def group(l, attrs=('name')):
-    """ Group list into dict hierachy based on attrs iterable.
+def keygetter(attrs):
+    """ Compiles a function returning the key (or tuple of keys, if there's
+        more than one) of an item from 'attrs', an attribute name (dotted
+        names are followed) or function, or an iterable of them.
     """
-    grouped = {}
+    if isinstance(attrs, basestring) or callable(attrs):
+        attrs = (attrs,)
+    attrs = tuple(attrs)
+    if not any(callable(attr) for attr in attrs):
+        return operator.attrgetter(*attrs)
+    getters = [attr if callable(attr) else operator.attrgetter(attr)
+               for attr in attrs]
+    if len(getters) == 1:
+        return getters[0]
+    return lambda i: tuple([get(i) for get in getters])
+
+def index(l, attrs=('name',), lists=False):
+    """ Index list into a flat dict, keyed on the keys (a tuple if more than
+        one) from attrs (see keygetter). Later items with the same keys
+        overwrite earlier ones, unless 'lists', in which case values are
+        lists of all the items with the keys.
+    """
+    key = keygetter(attrs)
+    if not lists:
+        return dict(itertools.izip(itertools.imap(key, l), l))
+    indexed = {}
     for i in l:
-        child = [eval('.'.join(('i', attr))) for attr in attrs]
-        child.append(i)
-        insert(grouped, *child)
+        k = key(i)
+        items = indexed.get(k)
+        if items is None:
+            indexed[k] = [i]
+        else:
+            items.append(i)
+    return indexed
+
+def group(l, attrs=('name',), lists=False):
+    """ Group list into dict hierachy based on attrs iterable (see
+        keygetter). Later items with the same keys overwrite earlier ones,
+        unless 'lists', in which case the leaves are lists of all the items
+        with those keys. (For a flat dict on the tuple of keys, see index.)
+    """
+    if isinstance(attrs, basestring) or callable(attrs):
+        attrs = (attrs,)
+    indexed = index(l, attrs, lists)
+    if len(attrs) < 2:
+        return indexed
+    grouped = {}
+    for keys, v in indexed.iteritems():
+        parent = grouped
+        for key in keys[:-1]:
+            child = parent.get(key)
+            if child is None:
+                child = parent[key] = {}
+            parent = child
+        parent[keys[-1]] = v
     return grouped
 
 def remove_children(group, test):
     """ Function to remove elements from dict hierachy using test function.
     """
-    for child in group:
-        if isinstance(child, dict):
-            remove_children(child, cmp)
-        else:
-            if test(child):
-                del child
+    prune(group, test)
 
 def flatten(d):
     """ Function to flatten dict hierachy.
     """
-    l = []
-    for i in d.itervalues():
-        if isinstance(i, dict):
-            l.extend(flatten(i))
-        else:
-            l.append(i)
-    return l
+    return list(iter_leaves(d))
+
+def flatten_paths(d, sep=None):
+    """ Function to flatten dict hierachy into a dict keyed on the tuple of
+        keys to each leaf (or, if 'sep' is given, the (string) keys joined
+        with it).
+    """
+    if sep is None:
+        return dict(iter_paths(d))
+    return dict((sep.join(path), v) for path, v in iter_paths(d))
 
+def unflatten(flat, sep=None):
+    """ Function to rebuild a dict hierachy from a flatten_paths() dict.
+    """
+    d = {}
+    for path, v in flat.iteritems():
+        if sep is not None:
+            path = path.split(sep)
+        parent = d
+        for key in path[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                child = parent[key] = {}
+            parent = child
+        parent[path[-1]] = v
+    return d
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+""" Concurrent HTTP fetching, with keep-alive connections pooled per host,
+    retries with exponential backoff, and a re-authentication hook.
+"""
+
+import sys
+import time
+import random
+import socket
+import logging
+import httplib
+import threading
+import urlparse
+import Queue
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+
+Response = namedtuple('Response', ('url', 'status', 'reason', 'headers',
+                                   'body'))
+
+
+class FetchError(IOError):
+    """ Raised when a URL couldn't be fetched in the allowed attempts; the
+        last Response (if any) is in 'response'.
+    """
+    def __init__(self, message, response=None):
+        IOError.__init__(self, message)
+        self.response = response
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    """ Returns how long to sleep before retry number 'attempt' (from 0):
+        a random time up to base * 2**attempt, but no more than 'cap' seconds
+        (i.e. exponential backoff with "full jitter").
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ConnectionPool(object):
+    """ Idle keep-alive connections, kept per (scheme, host, port).
+    """
+    connection_types = {'http': httplib.HTTPConnection,
+                        'https': httplib.HTTPSConnection}
+
+    def __init__(self, per_host=4, timeout=30):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """ Returns (connection, reused) for 'netloc'.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        log.debug("Connecting to {0}://{1}.".format(scheme, netloc))
+        return (self.connection_types[scheme](netloc, timeout=self.timeout),
+                False)
+
+    def put(self, scheme, netloc, connection):
+        """ Returns 'connection' to the pool (or closes it if the pool's
+            full).
+        """
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+class Fetcher(object):
+    """ Fetches URLs over pooled connections, at most 'concurrency' at a time.
+
+        Connection errors and 'retry_status' responses are retried, up to
+        'attempts' times, sleeping backoff(attempt, 'backoff', 'max_backoff')
+        in between. On a 'reauth_status' response 'reauth(fetcher, response)'
+        is called (if given), which can e.g. update fetcher.headers with a
+        new cookie; if it returns true the request is retried straight away.
+        GETs go through the 'cache' (a cache.ResponseCache) if given, keyed
+        on the URL and any Authorization and Cookie headers.
+    """
+    redirect_status = (301, 302, 303, 307, 308)
+
+    def __init__(self, concurrency=8, per_host=4, attempts=5, backoff=0.5,
+                 max_backoff=30.0, timeout=30, headers=None, reauth=None,
+                 reauth_status=(401, 590), retry_status=(500, 502, 503, 504),
+                 max_redirects=5, cache=None):
+        self.pool = ConnectionPool(per_host, timeout)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.headers = dict(headers or {})
+        self.reauth = reauth
+        self.reauth_status = reauth_status
+        self.retry_status = retry_status
+        self.max_redirects = max_redirects
+        self.cache = cache
+
+    def _request(self, method, url, body, headers):
+        """ Makes a single request, returns the Response.
+        """
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+        connection, reused = self.pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (socket.error, httplib.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            # The server probably closed the idle connection; try again on a
+            # new one.
+            log.debug("Reused connection to {0} failed, reconnecting."
+                        .format(parts.netloc))
+            connection, reused = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except Exception:
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(parts.scheme, parts.netloc, connection)
+        return Response(url, response.status, response.reason,
+                        dict(response.getheaders()), data)
+
+    def fetch(self, url, data=None, headers=None, method=None):
+        """ Fetches 'url' (POSTing 'data' if given), following redirects,
+            returns the Response; raises a FetchError if it fails.
+        """
+        method = method or ('POST' if data is not None else 'GET')
+        if self.cache is None or method != 'GET':
+            return self._fetch(url, data, headers, method)
+
+        def identity():
+            request_headers = dict(self.headers)
+            request_headers.update(headers or {})
+            return self.cache.identity(request_headers)
+
+        def request(validators):
+            request_headers = dict(headers or {})
+            request_headers.update(validators)
+            response = self._fetch(url, None, request_headers, method)
+            return response.status, response.headers, response.body
+
+        state = identity()
+        key = self.cache.key(url, *state)
+        entry = self.cache.fetch(key, url, request)
+        if identity() != state:
+            # Re-authenticated while fetching, so the response is the new
+            # identity's.
+            self.cache.cache.delete(key)
+            if entry.status == 200:
+                self.cache.set(self.cache.key(url, *identity()), entry.url,
+                               entry.status, entry.headers, entry.body)
+        return Response(entry.url, entry.status,
+                        httplib.responses.get(entry.status, ''),
+                        entry.headers, entry.body)
+
+    def _fetch(self, url, data, headers, method):
+        response = None
+        redirects = 0
+        attempt = 0
+        with self.slots:
+            while attempt < self.attempts:
+                request_headers = dict(self.headers)
+                request_headers.update(headers or {})
+                try:
+                    response = self._request(method, url, data,
+                                             request_headers)
+                except (socket.error, httplib.HTTPException) as ex:
+                    log.error("Caught {0} fetching {1}, retry number {2}."
+                                .format(ex, url, attempt))
+                    response = None
+                else:
+                    status = response.status
+                    if (status in self.redirect_status and
+                            'location' in response.headers and
+                            redirects < self.max_redirects):
+                        url = urlparse.urljoin(url,
+                                               response.headers['location'])
+                        redirects += 1
+                        if status == 303:
+                            method, data = 'GET', None
+                        continue
+                    if status in self.reauth_status and self.reauth:
+                        log.error("Got {0} for {1}, re-authenticating."
+                                    .format(status, url))
+                        if self.reauth(self, response):
+                            attempt += 1
+                            continue
+                    if status not in self.retry_status:
+                        return response
+                    log.error("Got {0} for {1}, retry number {2}."
+                                .format(status, url, attempt))
+                attempt += 1
+                if attempt < self.attempts:
+                    time.sleep(backoff(attempt - 1, self.backoff,
+                                       self.max_backoff))
+        raise FetchError("Fetching {0} failed after {1} attempts."
+                            .format(url, self.attempts), response)
+
+    def fetch_many(self, urls, threads=None, ordered=True):
+        """ Fetches 'urls' in parallel on 'threads' threads (default the
+            concurrency), generating (url, result) pairs, where the result is
+            the Response or the exception raised. Pairs are in the order of
+            'urls' if 'ordered', else as they complete. An exception raised
+            by 'urls' is raised after the pairs for the urls before it. If
+            the generator is closed early, urls not yet started are skipped.
+        """
+        threads = threads or self.concurrency
+        requests = Queue.Queue(threads * 2)
+        results = Queue.Queue()
+        done = object()
+        # Set when the caller's stopped, so the workers skip what's left.
+        stop = threading.Event()
+        # The exc_info of an exception raised by 'urls'.
+        failed = []
+
+        def worker():
+            while True:
+                item = requests.get()
+                if item is done:
+                    results.put(done)
+                    return
+                if stop.is_set():
+                    continue
+                i, url = item
+                try:
+                    result = self.fetch(url)
+                except Exception as ex:
+                    result = ex
+                results.put((i, url, result))
+
+        def feed(urls):
+            try:
+                for item in enumerate(urls):
+                    if stop.is_set():
+                        break
+                    requests.put(item)
+            except Exception:
+                failed.append(sys.exc_info())
+            finally:
+                for _ in range(threads):
+                    requests.put(done)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        workers.append(threading.Thread(target=feed, args=(urls,)))
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        pending = {}
+        n = 0
+        finished = 0
+        try:
+            while finished < threads:
+                item = results.get()
+                if item is done:
+                    finished += 1
+                    continue
+                i, url, result = item
+                if not ordered:
+                    yield url, result
+                    continue
+                pending[i] = url, result
+                while n in pending:
+                    yield pending.pop(n)
+                    n += 1
+        finally:
+            stop.set()
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+    def close(self):
+        """ Closes all idle connections.
+        """
+        self.pool.close()
+
+
+def fetch_many(urls, **kwds):
+    """ Convenience function: fetch_many() on a new Fetcher made with
+        'kwds', closing its connections when done.
+    """
+    fetcher = Fetcher(**kwds)
+    try:
+        for item in fetcher.fetch_many(urls):
+            yield item
+    finally:
+        fetcher.close()
+
+
+if __name__ == '__main__':
+    sys.stderr.write('\n'.join((__doc__, 'import only.', '')))
+    sys.exit(1)
@@ -3,6 +3,11 @@
 
 import sys
 import logging
+import httplib
+import threading
+import urlparse
+import Queue
+from contextlib import contextmanager
 
 import mechanize
 
@@ -14,9 +19,14 @@ def quote(s, safe=':/?='):
 
 
 class FormRedirectBrowser(mechanize.Browser):
-    def __init__(self, **kwds):
+    def __init__(self, cache=None, **kwds):
         mechanize.Browser.__init__(self, **kwds)
         self.log = logging.getLogger('Browser')
+        # {host: set of (form name, action)} of redirect forms passed.
+        self.passed = {}
+        # {host: user} authorisation added, for cache keys.
+        self.users = {}
+        self.cache = cache
 
     def add_password(self, url, user, passwd=None, **kwds):
         """ Add Authorisation for url.
@@ -29,6 +39,7 @@ class FormRedirectBrowser(mechanize.Browser):
             host = uri_parts[0]
         self.log.debug("Adding password for user: '{0}', hostname: '{1}'."
                         .format(user, host))
+        self.users[host] = user
         mechanize.Browser.add_password(self, host, user, passwd, **kwds)
 
     def redirect_open(self, url, form_name=None, **kwds):
@@ -36,37 +47,212 @@ class FormRedirectBrowser(mechanize.Browser):
             form given by 'form_name', until there is no such form.
             Originated due to the habit of imperial EEE to use these forms to 
             attempt to prevent scraping.
+            Once a host's redirect forms have been passed, the session's
+            cookies should get straight through, so later pages on the host
+            only submit forms seen in that first pass (i.e. if the session
+            has expired).
+            If the browser has a 'cache' (a cache.ResponseCache) GETs are
+            served from it, keyed on the url, 'form_name' and user.
         """
+        if self.cache is None or kwds.get('data') is not None:
+            return self._redirect_open(url, form_name, **kwds)
+        host = urlparse.urlsplit(url).netloc
+
+        def request(validators):
+            try:
+                responce = self._redirect_open(url, form_name, validators,
+                                               **kwds)
+            except mechanize.HTTPError as err:
+                if err.code != 304:
+                    raise
+                return 304, {}, ''
+            return responce.code, dict(responce.info()), responce.read()
+
+        entry = self.cache.fetch(self.cache.key(url, form_name,
+                                                self.users.get(host)),
+                                 url, request)
+        return mechanize.make_response(entry.body, entry.headers.items(),
+                                       entry.url, entry.status,
+                                       httplib.responses.get(entry.status,
+                                                             ''))
+
+    def _redirect_open(self, url, form_name=None, headers=None, **kwds):
+        host = urlparse.urlsplit(url).netloc
+        passed = self.passed.get(host)
         try:
             self.log.debug("Browsing to url: '{0}'.".format(url))
-            responce = self.open(url, **kwds)
+            responce = self.open(mechanize.Request(url, headers=headers)
+                                 if headers else url, **kwds)
+            forms = set()
             while self.viewing_html():
                 try:
                     if form_name:
                         self.select_form(name=form_name)
                     else:
                         self.select_form(nr=0)
+                    form = (self.form.name, self.form.action)
+                    if passed is not None and form not in passed:
+                        break
                     self.log.debug("Submitting form '{0}' for redirect."
                                     .format(form_name))
                     responce = self.submit()
+                    forms.add(form)
                 except mechanize.FormNotFoundError:
                     break
         except Error as err:
-            # If error, report and raise
-            self.log.error(str(err))
+            # If error, report and raise (a 304 is a cache revalidation)
+            if getattr(err, 'code', None) != 304:
+                self.log.error(str(err))
             raise
+        if forms:
+            # Only once some are passed do they limit what's submitted.
+            self.passed.setdefault(host, set()).update(forms)
         # Return responce body
         return responce
 
 
+class BrowserPool(object):
+    """ Pool of up to 'size' FormRedirectBrowser sessions, which keep their
+        cookies (and passed redirect forms) between uses. Each session is
+        only used for one host and user, so cookies, authorisation and cached
+        responses aren't shared between users.
+    """
+    def __init__(self, size=4, user=None, passwd=None, form_name=None,
+                 browser_type=FormRedirectBrowser, **kwds):
+        self.size = size
+        self.user = user
+        self.passwd = passwd
+        self.form_name = form_name
+        self.browser_type = browser_type
+        self.kwds = kwds
+        # {(host, user): [idle browser, ...]}, most recently used last.
+        self.idle = {}
+        self.created = 0
+        self.lock = threading.Condition()
+
+    @contextmanager
+    def browser(self, key=None):
+        """ Context manager giving an idle browser for 'key' (the (host, user)
+            it's used for), or a new one. If all 'size' exist, another key's
+            idle browser is closed to make room, else it waits for one.
+        """
+        with self.lock:
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    browser = idle.pop()
+                    if not idle:
+                        del self.idle[key]
+                    break
+                if self.created < self.size:
+                    self.created += 1
+                    browser = None
+                    break
+                if self.idle:
+                    other = next(iter(self.idle))
+                    idle = self.idle[other]
+                    idle.pop().close()
+                    if not idle:
+                        del self.idle[other]
+                    self.created -= 1
+                    continue
+                self.lock.wait()
+        if browser is None:
+            try:
+                browser = self.browser_type(**self.kwds)
+            except Exception:
+                # Free the slot, or once they're all gone it waits forever.
+                with self.lock:
+                    self.created -= 1
+                    self.lock.notify()
+                raise
+            browser.auth = set()
+        try:
+            yield browser
+        finally:
+            browser.clear_history()
+            with self.lock:
+                self.idle.setdefault(key, []).append(browser)
+                self.lock.notify()
+
+    def open(self, url, user=None, passwd=None, form_name=None, **kwds):
+        """ redirect_open()s 'url' on a pooled browser, adding authentication
+            as needed. 'user', 'passwd' and 'form_name' default to the
+            pool's.
+        """
+        user = user or self.user
+        passwd = passwd or self.passwd
+        auth = (urlparse.urlsplit(url).netloc, user)
+        with self.browser(auth) as browser:
+            if user and auth not in browser.auth:
+                browser.add_password(url, user, passwd)
+                browser.auth.add(auth)
+            return browser.redirect_open(url, form_name=form_name or
+                                              self.form_name, **kwds)
+
+    def crawl(self, urls, threads=None):
+        """ Opens 'urls' in parallel over 'threads' (default 'size')
+            sessions, generating (url, responce) pairs as they complete;
+            errors are given as the responce. An exception raised by 'urls'
+            is raised once the urls already started are done. If the
+            generator is closed early, the rest of 'urls' isn't opened.
+        """
+        threads = threads or self.size
+        urls = iter(urls)
+        results = Queue.Queue()
+        url_lock = threading.Lock()
+        done = object()
+        # Set when the caller's stopped, so the workers stop too.
+        stop = threading.Event()
+        # The exc_info of an exception raised by 'urls'.
+        failed = []
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    with url_lock:
+                        url = next(urls, done)
+                    if url is done:
+                        return
+                    try:
+                        responce = self.open(url)
+                    except Exception as err:
+                        responce = err
+                    results.put((url, responce))
+            except Exception:
+                failed.append(sys.exc_info())
+            finally:
+                results.put(done)
+
+        for _ in range(threads):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        finished = 0
+        try:
+            while finished < threads:
+                result = results.get()
+                if result is done:
+                    finished += 1
+                else:
+                    yield result
+        finally:
+            stop.set()
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+
+# Shared by formopen().
+browsers = BrowserPool()
+
+
 def formopen(url, user=None, passwd=None, form_name=None):
     """ Convinience function to use the FormRedirectBrowser, adding
-        authentication as needed.
+        authentication as needed. Browsers are reused from the 'browsers'
+        pool (a session per host and user), so the redirect forms are only
+        passed once per session.
     """
-    browser = FormRedirectBrowser()
-    if user:
-        browser.add_password(url, user, passwd)
-    return browser.redirect_open(url, form_name=form_name)
+    return browsers.open(url, user, passwd, form_name)
 
 
 
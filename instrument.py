@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+""" Low overhead instrumentation: stage timers, row and byte counters, and
+    optional cProfile (and, where available, tracemalloc) capture.
+
+    Nothing is recorded until enable() is called; until then timer() gives a
+    shared no-op context manager, and count(), counted() and timed() do
+    nothing, so the instrumented code pays for little more than a flag
+    check.
+    Results are available as a dict from snapshot(), or as JSON lines from
+    write_jsonl().
+"""
+
+import sys
+import json
+import time
+import logging
+import threading
+import cProfile
+import pstats
+from functools import wraps
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+log = logging.getLogger(__name__)
+
+# Whether anything is being recorded.
+enabled = False
+# Whether timed stages are profiled, and the cProfile.Profile they are.
+profiling = False
+profiler = None
+# Nesting of timed stages being profiled (in the main thread).
+_profile_depth = 0
+# [starting traced memory, peak before the last reset_peak()] for each
+# timed stage (in the main thread) while tracing memory.
+_memory_stack = []
+# The instrumented() stages each thread is in.
+_local = threading.local()
+
+
+class Stats(object):
+    """ Timings, counters and memory peaks, accumulated by name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # {stage: [calls, seconds]}
+            self.timers = {}
+            self.counters = {}
+            # {stage: peak traced bytes}
+            self.memory = {}
+
+    def time(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                self.timers[stage] = [1, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def peak(self, stage, size):
+        with self.lock:
+            self.memory[stage] = max(self.memory.get(stage, 0), size)
+
+    def snapshot(self):
+        """ Returns the stats as a dict of 'timers' ({stage: {'calls',
+            'seconds'}}), 'counters' and 'memory' (peak bytes per stage).
+        """
+        with self.lock:
+            return {'timers': dict((stage, {'calls': calls,
+                                            'seconds': seconds})
+                                   for stage, (calls, seconds)
+                                   in self.timers.iteritems()),
+                    'counters': dict(self.counters),
+                    'memory': dict(self.memory)}
+
+    def records(self):
+        """ Generates a dict per stat, with it's 'type' and 'name'.
+        """
+        snapshot = self.snapshot()
+        for stage, timer in sorted(snapshot['timers'].iteritems()):
+            yield dict(timer, type='timer', name=stage)
+        for name, n in sorted(snapshot['counters'].iteritems()):
+            yield {'type': 'counter', 'name': name, 'value': n}
+        for stage, size in sorted(snapshot['memory'].iteritems()):
+            yield {'type': 'memory', 'name': stage, 'peak_bytes': size}
+
+# The stats recorded.
+stats = Stats()
+
+
+class _NullTimer(object):
+    """ Context manager doing nothing, for when disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    """ Context manager recording the time spent in a stage (and profiling
+        it, and the peak traced memory it used, if those are enabled).
+    """
+    __slots__ = ('stage', 'start', 'profiling', 'tracing')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        global _profile_depth
+        main = threading.current_thread().name == 'MainThread'
+        self.profiling = profiling and main
+        if self.profiling:
+            if not _profile_depth:
+                profiler.enable()
+            _profile_depth += 1
+        self.tracing = (main and tracemalloc is not None and
+                        tracemalloc.is_tracing())
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if _memory_stack:
+                _memory_stack[-1][1] = max(_memory_stack[-1][1], peak)
+            _memory_stack.append([current, current])
+            tracemalloc.reset_peak()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _profile_depth
+        stats.time(self.stage, time.time() - self.start)
+        if self.profiling:
+            _profile_depth -= 1
+            if not _profile_depth:
+                profiler.disable()
+        if self.tracing and _memory_stack:
+            start, peak = _memory_stack.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            stats.peak(self.stage, peak - start)
+            if _memory_stack:
+                _memory_stack[-1][1] = max(_memory_stack[-1][1], peak)
+        return False
+
+
+def timer(stage):
+    """ Returns a context manager timing the code in it as 'stage'.
+    """
+    return _Timer(stage) if enabled else _null_timer
+
+
+def instrumented(stage):
+    """ Decorator timing each call of the function as 'stage' (except calls
+        made within it, e.g. recursive ones).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            stages = _local.__dict__.setdefault('stages', set())
+            if stage in stages:
+                return func(*args, **kwargs)
+            stages.add(stage)
+            try:
+                with _Timer(stage):
+                    return func(*args, **kwargs)
+            finally:
+                stages.discard(stage)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """ Adds 'n' to the counter 'name'.
+    """
+    if enabled:
+        stats.count(name, n)
+
+
+def counted(name, iterable):
+    """ Returns 'iterable', counting the items taken from it as 'name' (once
+        it's exhausted or closed).
+    """
+    if not enabled:
+        return iterable
+    return _counted(name, iterable)
+
+def _counted(name, iterable):
+    n = 0
+    try:
+        for n, item in enumerate(iterable, 1):
+            yield item
+    finally:
+        stats.count(name, n)
+
+
+def timed(stage, iterable, consumer=None):
+    """ Returns 'iterable', timing the taking of items from it as 'stage',
+        and if 'consumer' is given, the time between items (i.e. spent by
+        the code using them) as that stage.
+    """
+    if not enabled:
+        return iterable
+    return _timed(stage, iterable, consumer)
+
+def _timed(stage, iterable, consumer):
+    iterator = iter(iterable)
+    clock = time.time
+    inside = outside = 0.0
+    try:
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            end = clock()
+            inside += end - start
+            yield item
+            outside += clock() - end
+    finally:
+        stats.time(stage, inside)
+        if consumer:
+            stats.time(consumer, outside)
+
+
+def enable(profile=False, trace_memory=False):
+    """ Starts recording stats, and if 'profile', a cProfile of the (main
+        thread's) timed stages. If 'trace_memory', the peak memory each of
+        the main thread's stages used (above what was in use when it
+        started) is recorded with tracemalloc (which needs Python 3.9+).
+    """
+    global enabled, profiling, profiler
+    if trace_memory:
+        if not hasattr(tracemalloc, 'reset_peak'):
+            raise ValueError("Can't trace memory without tracemalloc "
+                             "(with reset_peak()).")
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if profile and profiler is None:
+        profiler = cProfile.Profile()
+    profiling = profile
+    enabled = True
+
+
+def disable():
+    """ Stops recording (but keeps what was recorded).
+    """
+    global enabled, profiling
+    enabled = profiling = False
+    del _memory_stack[:]
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset():
+    """ Discards the recorded stats and profile.
+    """
+    global profiler
+    stats.reset()
+    if profiler is not None:
+        profiler = cProfile.Profile()
+
+
+def snapshot():
+    """ Returns the recorded stats as a dict; see Stats.snapshot().
+    """
+    return stats.snapshot()
+
+
+def write_jsonl(fl=sys.stdout):
+    """ Writes the recorded stats to 'fl' as JSON lines, one per stat.
+    """
+    for record in stats.records():
+        fl.write(json.dumps(record, sort_keys=True))
+        fl.write('\n')
+
+
+def profile_stats(sort='cumulative'):
+    """ Returns a pstats.Stats of the profile (sorted by 'sort'), or None if
+        not profiling.
+    """
+    if profiler is None:
+        return None
+    return pstats.Stats(profiler).sort_stats(sort)
+
+
+if __name__ == '__main__':
+    sys.stderr.write('\n'.join((__doc__, 'import only.', '')))
+    sys.exit(1)
@@ -2,18 +2,30 @@
 """ Wrappers to nicely output data in different formats.
 """
 
+import os
 import sys
-#import os
+import Queue
 import logging
+import threading
+from itertools import islice
 #import csv
 
 from wrappers import s, header_join, ls, retry_open
 import unicode_csv as csv
+import instrument
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def repr2Dof2D(table, row_headers=None, column_headers=None, sep=None,
-               minor_sep=None, header_sep=None):
-    """Gives a string representation of a 2D array of 2D arrays."""
+
+def iter2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+               minor_sep=None, header_sep=None,
+               formats=None):
+    """ Generates the string representation of a 2D array of 2D arrays, row
+        by row; see repr2Dof2D().
+    """
     # Some pretty defaults
     if header_sep is None:
         header_sep = ('\t|| ', '\n========\n') if sep is None else sep
@@ -21,34 +33,88 @@ def repr2Dof2D(table, row_headers=None, column_headers=None, sep=None,
         minor_sep = (', ', '\n') if sep is None else sep
     if sep is None:
         sep = ('\t| ', '\n--------\n')
-    # Main body.
+    # Main body, as for header_join(rows, header_sep[1], sep[1]).
+    n = -1
+    for n, row in enumerate(_rows2Dof2D(table, row_headers, column_headers,
+                                        sep, minor_sep, header_sep,
+                                        formats)):
+        if n == 1:
+            yield header_sep[1]
+        elif n:
+            yield sep[1]
+        yield row
+    if n == 0:
+        yield header_sep[1]
+
+
+def _format_block(cell, join, formats=None):
+    """ Formats the rows of a numeric ndarray, each joined by 'join', as
+        str() would each element, or with 'formats': a %-format for all of
+        'cell', or a sequence of them, one per column.
+
+        The block is converted to Python numbers (or strings for default
+        float formatting) in one go, then each row is formatted by a single
+        %-format (or join), so there's no per element call.
+    """
+    cols = cell.shape[1]
+    if formats is None:
+        if cell.dtype.kind == 'f':
+            # Python's float formatting differs, so leave them to numpy.
+            return [join.join(row) for row in cell.astype(str).tolist()]
+        formats = '%s'
+    if isinstance(formats, basestring):
+        formats = [formats] * cols
+    fmt = join.replace('%', '%%').join(formats)
+    return [fmt % tuple(row) for row in cell.tolist()]
+
+
+def _rows2Dof2D(table, row_headers, column_headers, sep, minor_sep,
+                header_sep, formats=None):
+    """ Generates the rows of repr2Dof2D(), each row of inner rows joined.
+    """
     if column_headers:          # Add the top row
         if row_headers and len(column_headers) == len(table[0]):
             # Add the blank square in the top left
-            rows = [header_join([''] + column_headers, header_sep[0], sep[0])]
+            yield header_join([''] + column_headers, header_sep[0], sep[0])
         else:
-            rows = [header_join(column_headers, header_sep[0], sep[0])]
-    else:
-        rows = []
+            yield header_join(column_headers, header_sep[0], sep[0])
     for i, row in enumerate(table):
         cell_rows = []  # Initiate list with rows of each cell concat'ed.
         for cell in row:
-            for ii, cell_row in enumerate(cell):
+            if (numpy and isinstance(cell, numpy.ndarray) and
+                    cell.ndim == 2 and cell.dtype.kind in 'biuf'):
+                # Fast path for numeric blocks.
+                lines = _format_block(cell, minor_sep[0], formats)
+            else:
+                lines = [minor_sep[0].join(s(cell_row)) for cell_row in cell]
+            for ii, line in enumerate(lines):
                 if len(cell_rows) <= ii:        # if first column, initiate row
                     if row_headers:
                         # Add the header or a blank filler.
                         cell_rows.append([row_headers[i]] if ii == 0 else [''])
                     else:
                         cell_rows.append([])
-                cell_rows[ii].append(minor_sep[0].join(s(cell_row)))
-        rows.append(minor_sep[1].join([header_join(r, header_sep[0], sep[0])
-                                        for r in cell_rows]))
-    return header_join(rows, header_sep[1], sep[1])
+                cell_rows[ii].append(line)
+        yield minor_sep[1].join([header_join(r, header_sep[0], sep[0])
+                                 for r in cell_rows])
 
 
-def latex2Dof2D(table, row_headers=None, column_headers=None, sep=None,
-                minor_sep=None, header_sep=None):
-    """Wrapper around repr2Dof2D() for LaTeX tabular environments."""
+def repr2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+               minor_sep=None, header_sep=None,
+               formats=None):
+    """ Gives a string representation of a 2D array of 2D arrays.
+
+        Numeric ndarray cells are formatted a block at a time, as str() would
+        or with 'formats': a %-format, or sequence of them per inner column.
+    """
+    return ''.join(iter2Dof2D(table, row_headers, column_headers, sep,
+                              minor_sep, header_sep, formats))
+
+
+def iterlatex2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+                    minor_sep=None, header_sep=None,
+                    formats=None):
+    """Generates latex2Dof2D() output, row by row."""
     # Some pretty defaults (requires booktabs package.
     cols = table.shape[1]
     inner_cols = table[0, 0].shape[1]
@@ -68,19 +134,33 @@ def latex2Dof2D(table, row_headers=None, column_headers=None, sep=None,
     header += '|'.join([' '.join(['r'] * inner_cols)] * cols)
     header += '}\n'
     # Make headers span correct number of cells.
-    r_h = map(lambda r: '\\multirow{%s}{*}{%s}' % (table[0, 0].shape[0], r),
-              row_headers)
-    c_h = map(lambda c: '\\multicolumn{%s}{|c}{%s}' % (table[0, 0].shape[1],
-                                                       c),
-              column_headers)
-    str_repr = repr2Dof2D(table, r_h, c_h, sep, minor_sep, header_sep)
-    footer = '\t\\\\\n\\end{tabular}'
-    return '\n'.join((header, str_repr, footer))
+    r_h = row_headers and map(lambda r: '\\multirow{%s}{*}{%s}' %
+                                            (table[0, 0].shape[0], r),
+                              row_headers)
+    c_h = column_headers and map(lambda c: '\\multicolumn{%s}{|c}{%s}' %
+                                                (table[0, 0].shape[1], c),
+                                 column_headers)
+    yield header
+    yield '\n'
+    for chunk in iter2Dof2D(table, r_h, c_h, sep, minor_sep, header_sep,
+                            formats):
+        yield chunk
+    yield '\n'
+    yield '\t\\\\\n\\end{tabular}'
 
 
-def booktabs2Dof2D(table, row_headers=None, column_headers=None, sep=None,
-                   minor_sep=None, header_sep=None):
-    """Wrapper around repr2Dof2D() for LaTeX booktabs tabular environments."""
+def latex2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+                minor_sep=None, header_sep=None,
+                formats=None):
+    """Wrapper around repr2Dof2D() for LaTeX tabular environments."""
+    return ''.join(iterlatex2Dof2D(table, row_headers, column_headers, sep,
+                                   minor_sep, header_sep, formats))
+
+
+def iterbooktabs2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+                       minor_sep=None, header_sep=None,
+                       formats=None):
+    """Generates booktabs2Dof2D() output, row by row."""
     # Some pretty defaults (requires booktabs package.
     cols = table.shape[1]
     inner_cols = table[0, 0].shape[1]
@@ -109,13 +189,27 @@ def booktabs2Dof2D(table, row_headers=None, column_headers=None, sep=None,
     header += ' '.join([' '.join(['r'] * inner_cols)] * cols)
     header += '}\n\\toprule'
     # Make headers span correct number of cells.
-    r_h = map(lambda r: '\\multirow{%s}{*}{%s}' % (table[0, 0].shape[0], r),
-              row_headers)
-    c_h = map(lambda c: '\\multicolumn{%s}{c}{%s}' % (table[0, 0].shape[1], c),
-              column_headers)
-    str_repr = repr2Dof2D(table, r_h, c_h, sep, minor_sep, header_sep)
-    footer = '\t\\\\ \\bottomrule\n\\end{tabular}'
-    return '\n'.join((header, str_repr, footer))
+    r_h = row_headers and map(lambda r: '\\multirow{%s}{*}{%s}' %
+                                            (table[0, 0].shape[0], r),
+                              row_headers)
+    c_h = column_headers and map(lambda c: '\\multicolumn{%s}{c}{%s}' %
+                                                (table[0, 0].shape[1], c),
+                                 column_headers)
+    yield header
+    yield '\n'
+    for chunk in iter2Dof2D(table, r_h, c_h, sep, minor_sep, header_sep,
+                            formats):
+        yield chunk
+    yield '\n'
+    yield '\t\\\\ \\bottomrule\n\\end{tabular}'
+
+
+def booktabs2Dof2D(table, row_headers=None, column_headers=None, sep=None,
+                   minor_sep=None, header_sep=None,
+                   formats=None):
+    """Wrapper around repr2Dof2D() for LaTeX booktabs tabular environments."""
+    return ''.join(iterbooktabs2Dof2D(table, row_headers, column_headers, sep,
+                                      minor_sep, header_sep, formats))
 
 
 class OutputBase(object):
@@ -130,7 +224,7 @@ class OutputBase(object):
             fl = self.file_name
         self.file = retry_open(fl, *args, **kwargs)
         self.file_name = fl
-        self.log.debug("Opened {0} for writing.".format(fl))
+        self.log.debug("Opened %s for writing.", fl)
         return self.file
 
     def write(self, message):
@@ -139,8 +233,10 @@ class OutputBase(object):
     def close(self, fl=None, *args, **kwargs):
         if fl == None:
             fl = self.file
+        if instrument.enabled and not fl.closed:
+            instrument.count('output.bytes', fl.tell())
         fl.close(*args, **kwargs)
-        self.log.debug("{0} closed.".format(fl.name))
+        self.log.debug("%s closed.", fl.name)
 
     #def __del__(self):
         #if not self.file.closed:
@@ -159,21 +255,119 @@ class OutputCsv(OutputBase):
 
     def open(self, *args, **kwargs):
         super(self.__class__, self).open(*args, **kwargs)
-        self.csv = csv.writer(self.file, lineterminator='\n')
+        self.csv = csv.writer(self.file, lineterminator='\n',
+                              buffer_size=1 << 16)
+        self.header = self.file.tell() != 0
         return self.file
 
     def writerow(self, row):
-        if self.file.tell() == 0:
+        if not self.header:
             if hasattr(row, '_fields'):
                 self.csv.writerow(row._fields)
+            self.header = True
         self.csv.writerow(row)
 
+    def close(self, *args, **kwargs):
+        self.csv.flush()
+        super(self.__class__, self).close(*args, **kwargs)
+
 
 try:
     import xlwt
+    import datetime
+
+    # Number formats for cell types that need one.
+    _xl_formats = {datetime.datetime: 'YYYY-MM-DD HH:MM:SS',
+                   datetime.date: 'YYYY-MM-DD',
+                   datetime.time: 'HH:MM:SS',
+                  }
 
     class OutputXl(OutputBase):
-        pass
+        """ Writes rows to an Excel workbook, using xlwt.
+
+            Every 'flush_rows' rows the sheet's rows are flushed to xlwt's
+            packed record data, so the cell objects don't build up in memory,
+            and when a sheet reaches 'max_rows' rows, a new one is started
+            (repeating the header). Cell styles are made once per type.
+
+            xlwt can only save a whole workbook, so the packed rows are all
+            held until close(): memory is still O(rows), about 130 bytes a
+            cell (half that of not flushing). Use OutputCsv for tables too
+            big for that.
+        """
+        max_rows = 65536
+        flush_rows = 1000
+
+        def __init__(self, *args, **kwargs):
+            super(self.__class__, self).__init__(*args, **kwargs)
+            if '.xls' in self.name:
+                self.file_name = self.name
+                self.name = self.name.partition('.xls')[0]
+            else:
+                self.file_name = '.'.join((self.name, 'xls'))
+            self.open(mode='wb')
+
+        def open(self, *args, **kwargs):
+            super(self.__class__, self).open(*args, **kwargs)
+            self.book = xlwt.Workbook(encoding='utf-8')
+            self.sheet = None
+            self.sheets = 0
+            self.heading = None
+            self.styles = {}
+            return self.file
+
+        def _style(self, value):
+            """ Returns the (cached) style for cells like 'value'.
+            """
+            kind = type(value)
+            try:
+                return self.styles[kind]
+            except KeyError:
+                fmt = _xl_formats.get(kind)
+                style = (xlwt.easyxf(num_format_str=fmt) if fmt
+                            else xlwt.Style.default_style)
+                self.styles[kind] = style
+                return style
+
+        def _add_sheet(self):
+            """ Starts a new sheet, with the header row if there is one.
+            """
+            if self.sheet is not None:
+                self.sheet.flush_row_data()
+            self.sheets += 1
+            name = ''.join(c for c in os.path.basename(self.name)
+                           if c not in '[]:*?/\\') or 'Sheet'
+            if self.sheets > 1:
+                name = '{0} {1}'.format(name[:27], self.sheets)
+            self.sheet = self.book.add_sheet(name[:31])
+            self.row = 0
+            if self.heading:
+                self._write(self.heading)
+
+        def _write(self, row):
+            write = self.sheet.row(self.row).write
+            for col, value in enumerate(row):
+                write(col, value, self._style(value))
+            self.row += 1
+            if self.row % self.flush_rows == 0:
+                self.sheet.flush_row_data()
+
+        def writerow(self, row):
+            if self.sheet is None:
+                if hasattr(row, '_fields'):
+                    self.heading = row._fields
+                self._add_sheet()
+            elif self.row >= self.max_rows:
+                self._add_sheet()
+            self._write(row)
+
+        def close(self, fl=None, *args, **kwargs):
+            if fl == None:
+                fl = self.file
+            if self.sheet is None:
+                self._add_sheet()
+            self.book.save(fl)
+            super(self.__class__, self).close(fl, *args, **kwargs)
 except ImportError:
     pass
 
@@ -182,6 +376,14 @@ try:
     from htmlgen import HTMLgen
 
     class OutputHtml(OutputBase):
+        """ Streams an HTMLgen table document to file.
+
+            The document head is written with the first row (once the table
+            heading is known), then each row as it's written, and the foot on
+            close, so only one row is held in memory at a time. Each part is
+            rendered by HTMLgen itself, and sliced out of the table markup, so
+            the output is the same as rendering the whole document at once.
+        """
         def __init__(self, *args, **kwargs):
             super(self.__class__, self).__init__(*args, **kwargs)
             if '.htm' in self.name:
@@ -199,33 +401,142 @@ try:
             self.table = HTMLgen.Table(tabletitle=title)
             self.table.body = []
             self.html.append(self.table)
+            self.foot = None
             return self.file
 
+        def _render(self, row):
+            """ Renders the table with just 'row' as it's body.
+            """
+            self.table.body = [row]
+            markup = str(self.table)
+            self.table.body = []
+            return markup
+
+        def _start(self, row):
+            """ Writes the document up to the table body, and works out where
+                rows go in the table markup (from the first 'row').
+            """
+            empty = str(self.table)
+            markup = self._render(row)
+            # Rows go on the last line boundary both renderings share.
+            common = os.path.commonprefix((empty, markup))
+            split = common.rfind('\n') + 1
+            if not markup.endswith(empty[split:]):
+                raise ValueError("Can't find where rows go in the table.")
+            document = str(self.html)
+            i = document.index(empty)
+            self.file.write(document[:i] + empty[:split])
+            self.foot = empty[split:] + document[i + len(empty):]
+            self.row_slice = slice(split, -len(empty[split:]) or None)
+
         def writerow(self, row):
             if not self.table.heading:
                 if hasattr(row, '_fields'):
                     self.table.heading = row._fields
-            self.table.body.append(list(row))
+            row = list(row)
+            if self.foot is None:
+                self._start(row)
+            self.file.write(self._render(row)[self.row_slice])
 
         def close(self, fl=None, *args, **kwargs):
             if fl == None:
                 fl = self.file
-            fl.write(str(self.html))
+            if self.foot is None:
+                fl.write(str(self.html))
+            else:
+                fl.write(self.foot)
             super(self.__class__, self).close(fl, *args, **kwargs)
 except ImportError:
     pass
 
 
-def table(rows, name='output', types=('csv',)):
+class _Sink(threading.Thread):
+    """ Thread writing the batches of rows put on it's bounded queue to an
+        output, then closing it.
+
+        If writing fails, the error is kept (to be reported by table()) and
+        the rest of the queue is drained, so the producer never blocks.
+    """
+    done = object()
+
+    def __init__(self, output, queue_size):
+        threading.Thread.__init__(self, name=repr(output))
+        self.daemon = True
+        self.output = output
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        # Whether 'done' has been taken from the queue (so there's nothing
+        # left to drain).
+        finished = False
+        try:
+            for rows in iter(self.queue.get, self.done):
+                _write(self.output, rows)
+            finished = True
+            _write(self.output, close=True)
+        except Exception:
+            self.error = sys.exc_info()
+            logging.getLogger(__name__).error("Error writing to %s: %s",
+                                              self.name, self.error[1])
+            if not finished:
+                while self.queue.get() is not self.done:
+                    pass
+
+
+def _write(output, rows=(), close=False):
+    """ Writes 'rows' to 'output' (and closes it if 'close'), timing it as
+        the output's stage.
+    """
+    with instrument.timer('output.' + type(output).__name__):
+        writerow = output.writerow
+        for row in rows:
+            writerow(row)
+        if close:
+            output.close()
+
+
+@instrument.instrumented('table')
+def table(rows, name='output', types=('csv',), queue_size=64, batch=256):
+    """ Writes rows to a file of each type in 'types', in batches of 'batch'
+        rows.
+
+        With multiple types, each output is written by it's own thread, fed
+        through a queue of at most 'queue_size' batches, so slow outputs
+        only hold up the others once their queue is full. If any
+        output fails, the others are still finished, then the first error is
+        raised.
+    """
     log = logging.getLogger(__name__.title())
-    log.info("Attempting to write list to file type(s): " + ls(types))
+    log.info("Attempting to write list to file type(s): %s", ls(types))
     op_names = [''.join(('Output', t.title())) for t in types]
     env = globals()
     outputs = [env[op_n](name) for op_n in op_names if op_n in env]
-    log.debug("Found valid output types: " + ls(outputs))
-    for row in rows:
-        [output.writerow(row) for output in outputs]
-    [output.close() for output in outputs]
+    log.debug("Found valid output types: %s", ls(outputs))
+    # Time getting the rows (e.g. parsing them lazily) apart from writing.
+    rows = iter(instrument.timed('table.input',
+                                 instrument.counted('table.rows', rows)))
+    if len(outputs) < 2:
+        chunk = list(islice(rows, batch))
+        while chunk:
+            [_write(output, chunk) for output in outputs]
+            chunk = list(islice(rows, batch))
+        [_write(output, close=True) for output in outputs]
+        return
+    sinks = [_Sink(output, queue_size) for output in outputs]
+    [sink.start() for sink in sinks]
+    puts = [sink.queue.put for sink in sinks]
+    try:
+        chunk = list(islice(rows, batch))
+        while chunk:
+            [put(chunk) for put in puts]
+            chunk = list(islice(rows, batch))
+    finally:
+        [put(_Sink.done) for put in puts]
+        [sink.join() for sink in sinks]
+    errors = [sink.error for sink in sinks if sink.error]
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+""" Tests for dict_.
+"""
+
+import unittest
+
+import dict_
+
+
+class MergeAllTest(unittest.TestCase):
+
+    def merge(self, old, policy):
+        return dict_.merge_all({'x': old}, {'x': {'y': 1}}, policy=policy)
+
+    def test_truthy(self):
+        self.assertEqual(self.merge(5, 'truthy'), {'x': {'y': 1}})
+
+    def test_allow_false(self):
+        self.assertEqual(self.merge(0, 'allow_false'), {'x': {'y': 1}})
+
+    def test_always(self):
+        self.assertEqual(self.merge(5, 'always'), {'x': {'y': 1}})
+
+    def test_fill(self):
+        self.assertEqual(self.merge(5, 'fill'), {'x': 5})
+        self.assertEqual(self.merge(None, 'fill'), {'x': {'y': 1}})
+
+    def test_custom_policy(self):
+        never = lambda old, new: False
+        self.assertEqual(self.merge(5, never), {'x': 5})
+
+    def test_nested_dicts_merge(self):
+        base = {'x': {'y': 1, 'z': 2}}
+        self.assertEqual(dict_.merge_all(base, {'x': {'y': 3}}, policy='fill'),
+                         {'x': {'y': 1, 'z': 2}})
+        self.assertEqual(dict_.merge_all(base, {'x': {'w': 4}}, policy='fill'),
+                         {'x': {'y': 1, 'z': 2, 'w': 4}})
+
+
+if __name__ == '__main__':
+    unittest.main()
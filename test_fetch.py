@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+""" Tests for fetch.
+"""
+
+import time
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import fetch
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        time.sleep(0.05)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FetchManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.paths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{0}/'.format(self.server.server_port)
+        self.fetcher = fetch.Fetcher(concurrency=2)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_thread(self, target):
+        result = {}
+
+        def run():
+            try:
+                result['value'] = target()
+            except Exception as ex:
+                result['error'] = ex
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "fetch_many() hung")
+        return result
+
+    def test_urls_error_is_raised(self):
+        def urls():
+            yield self.base + '0'
+            raise ValueError("bad url list")
+        got = []
+
+        def run():
+            for url, response in self.fetcher.fetch_many(urls()):
+                got.append(response.status)
+        result = self.run_thread(run)
+        self.assertIsInstance(result.get('error'), ValueError)
+        self.assertEqual(got, [200])
+
+    def test_stop_early(self):
+        urls = [self.base + str(i) for i in range(40)]
+
+        def run():
+            for item in self.fetcher.fetch_many(urls):
+                break
+        self.run_thread(run)
+        time.sleep(0.3)
+        self.assertLess(len(self.server.paths), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+""" Tests for ic.
+"""
+
+import threading
+import unittest
+
+import ic
+
+
+class FakeBrowser(object):
+    """ Stands in for a FormRedirectBrowser, recording what it's asked.
+    """
+    def __init__(self):
+        self.users = {}
+        self.closed = False
+
+    def add_password(self, url, user, passwd=None):
+        self.users[url] = user
+
+    def redirect_open(self, url, form_name=None):
+        return self
+
+    def clear_history(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class BrowserPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ic.BrowserPool(size=2, browser_type=FakeBrowser)
+
+    def test_sessions_per_user(self):
+        alice = self.pool.open('http://a/1', 'alice', 'pw')
+        bob = self.pool.open('http://a/2', 'bob', 'pw')
+        self.assertIsNot(alice, bob)
+        self.assertIs(self.pool.open('http://a/3', 'alice', 'pw'), alice)
+        self.assertIs(self.pool.open('http://a/4', 'bob', 'pw'), bob)
+
+    def test_idle_session_replaced(self):
+        alice = self.pool.open('http://a/1', 'alice', 'pw')
+        self.pool.open('http://a/2', 'bob', 'pw')
+        carol = self.pool.open('http://a/3', 'carol', 'pw')
+        self.assertEqual(self.pool.created, 2)
+        self.assertTrue(alice.closed)
+        self.assertNotIn(alice, (carol, self.pool.open('http://a/4', 'alice')))
+
+    def crawl(self, urls):
+        result = {}
+
+        def run():
+            try:
+                result['pairs'] = list(self.pool.crawl(urls))
+            except Exception as ex:
+                result['error'] = ex
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "crawl() hung")
+        return result
+
+    def test_crawl(self):
+        urls = ['http://a/{0}'.format(i) for i in range(5)]
+        pairs = self.crawl(urls)['pairs']
+        self.assertEqual(sorted(url for url, responce in pairs), urls)
+
+    def test_crawl_urls_error(self):
+        def urls():
+            yield 'http://a/1'
+            raise ValueError("bad url list")
+        self.assertIsInstance(self.crawl(urls()).get('error'), ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
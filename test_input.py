@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+""" Tests for input.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import input
+
+
+class CsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def csv(self, text, name='test.csv'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fl:
+            fl.write(text)
+        return path
+
+
+class ConverterTest(CsvTest):
+
+    def test_short_rows(self):
+        path = self.csv("a,b,c\r\n1,x,3\r\n2,y,z\r\n\r\n5\r\n")
+        rows = input.csv2list(path, return_type=list, dialect='excel',
+                              has_header=True, converters=[int, None, int],
+                              errors='keep')
+        self.assertEqual(rows[1:], [[1, 'x', 3], [2, 'y', 'z'], [], [5]])
+
+    def test_short_row_by_index(self):
+        path = self.csv("a,b,c\r\n1,x,3\r\n2,y\r\n")
+        converters = {0: int, 2: int}
+        rows = input.csv2list(path, return_type=list, dialect='excel',
+                              has_header=True, converters=converters)
+        self.assertEqual(rows[1:], [[1, 'x', 3], [2, 'y']])
+
+    def test_infer_whole_file(self):
+        # The float is beyond the sniffed sample.
+        rows = ["{0},{0},n{0}".format(i) for i in range(20)]
+        rows[15] = "15.5,15,n15"
+        path = self.csv("a,b,c\r\n" + "\r\n".join(rows) + "\r\n")
+        rows = input.csv2list(path, return_type=list, dialect='excel',
+                              has_header=True, converters='infer')
+        self.assertEqual(set(type(row[0]) for row in rows[1:]), set([float]))
+        self.assertEqual(set(type(row[1]) for row in rows[1:]), set([int]))
+        self.assertEqual(rows[16], [15.5, 15, 'n15'])
+
+    def test_infer_stream_raises(self):
+        rows = ["{0},{0}".format(i) for i in range(20)]
+        rows[15] = "15.5,15"
+        path = self.csv("a,b\r\n" + "\r\n".join(rows) + "\r\n")
+        # A pipe can't seek back, so only the sample is inferred from.
+        read, write = os.pipe()
+        with open(path, 'rb') as fl:
+            os.write(write, fl.read())
+        os.close(write)
+        with os.fdopen(read, 'rb') as stream:
+            self.assertRaises(ValueError, input.csv2list, stream,
+                              return_type=list, dialect='excel',
+                              has_header=True, converters='infer')
+
+
+class ColumnsTest(CsvTest):
+
+    def test_columns(self):
+        path = self.csv("a,b\r\n1,2\r\n3,4\r\n\r\n5,x\r\n")
+        columns = input.csv2columns(path, dialect='excel', has_header=True)
+        self.assertEqual(list(columns['a']), [1, 3, 5])
+        self.assertEqual(list(columns['b']), ['2', '4', 'x'])
+
+    def test_short_row(self):
+        path = self.csv("a,b\r\n1,2\r\n3,4\r\n5\r\n8,9\r\n")
+        with self.assertRaisesRegexp(ValueError, 'row 3 .* 1 fields'):
+            input.csv2columns(path, dialect='excel', has_header=True)
+
+    def test_long_row(self):
+        path = self.csv("a,b\r\n1,2,3\r\n")
+        with self.assertRaisesRegexp(ValueError, 'row 1 .* 3 fields'):
+            input.csv2columns(path, dialect='excel', has_header=True)
+
+
+class IndexedTableTest(CsvTest):
+
+    def test_single_index_spec(self):
+        path = self.csv("key,name,size\r\na,x,1\r\nb,y,2\r\nc,x,3\r\n")
+        table = input.csv2dict(path, indexes='name', sorted_indexes='size',
+                               dialect='excel', has_header=True)
+        self.assertEqual([row.size for row in table.lookup('name', 'x')],
+                         ['1', '3'])
+        self.assertEqual([row.name for row in table.range('size', '2')],
+                         ['y', 'x'])
+
+    def test_single_function_spec(self):
+        path = self.csv("key,name\r\na,x\r\nb,Y\r\n")
+        lower = lambda row: row.name.lower()
+        table = input.csv2dict(path, indexes=lower, dialect='excel',
+                               has_header=True)
+        self.assertEqual(table.lookup(lower, 'y'), [table['b']])
+
+
+if __name__ == '__main__':
+    unittest.main()
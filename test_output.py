@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+""" Tests for output.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import output
+
+
+class FailingClose(output.OutputBase):
+    """ Output whose close() fails, as e.g. a flush to a full disk would.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+    def close(self, *args, **kwargs):
+        raise IOError("No space left on device")
+
+
+class TableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        output.OutputFailingclose = FailingClose
+
+    def tearDown(self):
+        del output.OutputFailingclose
+        shutil.rmtree(self.dir)
+
+    def test_sink_close_error_is_raised(self):
+        result = {}
+
+        def run():
+            try:
+                output.table([('a', 1), ('b', 2)],
+                             os.path.join(self.dir, 'out'),
+                             ('csv', 'failingclose'))
+            except IOError as ex:
+                result['error'] = ex
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "table() hung")
+        self.assertIn('No space', str(result.get('error')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'out.csv')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+""" Tests for wrappers.
+"""
+
+import threading
+import unittest
+
+import wrappers
+
+
+class StripHtmlTest(unittest.TestCase):
+
+    def test_unquoted_apostrophe(self):
+        self.assertEqual(wrappers.strip_html("<p>a<img alt=don't>b</p> c"),
+                         "ab c")
+
+    def test_quoted_attribute(self):
+        self.assertEqual(wrappers.strip_html('<a title="x>y">d</a>'), 'd')
+
+    def test_quoted_attribute_split(self):
+        stripper = wrappers.HtmlStripper()
+        text = stripper.feed('x<a title="x>')
+        text += stripper.feed('y">d</a>')
+        self.assertEqual(text + stripper.close(), 'xd')
+
+    def test_unclosed_tag_buffer(self):
+        stripper = wrappers.HtmlStripper()
+        stripper.max_tag = 100
+        text = stripper.feed('a <b c=')
+        for _ in range(10):
+            text += stripper.feed('"' + 'z' * 50)
+        self.assertLess(len(stripper.buffer), 200)
+        self.assertTrue(text.startswith('a <b c="zz'))
+
+
+class KeyNormaliserTest(unittest.TestCase):
+
+    def test_unhashable(self):
+        normaliser = wrappers.KeyNormaliser()
+        self.assertEqual(normaliser([u'A', u'b']), 'uaub')
+        self.assertEqual(normaliser.links, {})
+
+    def test_errors_raised_once(self):
+        calls = []
+
+        def normalise(k):
+            calls.append(k)
+            raise TypeError("broken")
+        normaliser = wrappers.KeyNormaliser()
+        normaliser.func = normaliser.normalise = normalise
+        self.assertRaises(TypeError, normaliser, u'key')
+        self.assertEqual(calls, [u'key'])
+
+
+class LRUMemoTest(unittest.TestCase):
+
+    def test_lru(self):
+        memo = wrappers.LRUMemo(lambda x: x * 2, size=2)
+        self.assertEqual([memo(1), memo(2), memo(1), memo(3)], [2, 4, 2, 6])
+        self.assertEqual(sorted(memo.links), [1, 3])
+
+    def test_threads(self):
+        memo = wrappers.LRUMemo(lambda x: x * 2, size=8)
+
+        def run():
+            for i in range(2000):
+                memo(i % 13)
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(memo.links), 8)
+        # Walk the list both ways: every link is in it once.
+        forward, link = [], memo.root[1]
+        while link is not memo.root:
+            forward.append(link[2])
+            link = link[1]
+        backward, link = [], memo.root[0]
+        while link is not memo.root:
+            backward.append(link[2])
+            link = link[0]
+        self.assertEqual(sorted(forward), sorted(memo.links))
+        self.assertEqual(backward, forward[::-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,28 @@
 """
 
 import csv
+import mmap
 import codecs
 import cStringIO
 
+
+def _is_utf8(encoding):
+    """ Whether 'encoding' is (an alias of) UTF-8.
+    """
+    return codecs.lookup(encoding).name == 'utf-8'
+
+
+def _mmap(f):
+    """ Memory-maps the rest of file "f" (from it's current position), or
+        returns None if it can't be mapped (e.g. it's a pipe, or empty).
+    """
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mapped.seek(f.tell())
+    except (AttributeError, IOError, ValueError, EnvironmentError):
+        return None
+    return mapped
+
 class UTF8Recoder:
     """ Iterator to read an encoded stream and reencode to UTF-8.
     """
@@ -21,10 +40,20 @@ class UTF8Recoder:
 class UnicodeReader:
     """ A CSV reader to iterate over lines in the CSV file "f", encoded in the 
         given encoding.
+
+        UTF-8 files are parsed as is, so each cell is only decoded once. If
+        "use_mmap" is set, the file is memory-mapped, rather than read through
+        the file object's buffers (falling back to that if it can't be).
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", use_mmap=False,
+                 **kwds):
+        mapped = _mmap(f) if use_mmap else None
+        if _is_utf8(encoding):
+            if mapped is not None:
+                f = iter(mapped.readline, '')
+        else:
+            f = UTF8Recoder(f if mapped is None else mapped, encoding)
         self.reader = csv.reader(f, dialect=dialect, **kwds)
         self.line_num = self.reader.line_num
 
@@ -39,32 +68,55 @@ class UnicodeReader:
 class UnicodeWriter:
     """ A CSV writer to write rows to CSV file "f", encoded in the given 
         encoding.
+
+        Rows are buffered until at least "buffer_size" bytes are waiting (by
+        default every row is written straight away), then encoded and written
+        to "f" in one go. writerows() always batches rows, and flush() writes
+        out anything still buffered, so must be called before closing "f".
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", buffer_size=0,
+                 **kwds):
         # Redirect output to a queue
         self.queue = cStringIO.StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
         self.encoding = encoding
+        self.utf8 = _is_utf8(encoding)
         self.encoder = codecs.getincrementalencoder(encoding)()
+        self.buffer_size = buffer_size
 
     def writerow(self, row):
         self.writer.writerow([unicode(s).encode("utf-8") for s in row])
+        if self.queue.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        writerow = self.writer.writerow
+        queue = self.queue
+        buffer_size = max(self.buffer_size, 1 << 16)
+        for row in rows:
+            writerow([unicode(s).encode("utf-8") for s in row])
+            if queue.tell() >= buffer_size:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        """ Writes any buffered rows to the target stream.
+        """
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
-        if self.encoding is not "utf-8":
+        if not data:
+            return
+        if not self.utf8:
             data = data.decode("utf-8")
             # ... and reencode it into the target encoding
             data = self.encoder.encode(data)
         # write to the target stream
         self.stream.write(data)
         # empty queue
-        self.queue.truncate(0)
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        self.queue.seek(0)
+        self.queue.truncate()
 
 
 reader = UnicodeReader
@@ -8,10 +8,17 @@ import sys
 import time
 import codecs
 import re
+import threading
 from collections import Iterable
 
+import urllib
 import urllib2
+import mimetools
 import logging
+from cStringIO import StringIO
+from htmlentitydefs import name2codepoint
+
+from fetch import backoff
 
 
 log = logging.getLogger(__name__)
@@ -49,24 +56,159 @@ def ls(iterable):
     return string.join("''")
 
 
+class LRUMemo(object):
+    """ Memoises a function of one (hashable) argument, keeping the results
+        for the 'size' most recently used arguments. It's thread-safe: the
+        cache is updated under a lock, but 'func' is called outside it (so
+        may be called more than once for an argument).
+    """
+    def __init__(self, func, size=1024):
+        self.func = func
+        self.size = size
+        self.links = {}
+        # Circular doubly linked list of [prev, next, arg, result], most
+        # recently used last.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def __call__(self, arg):
+        # (acquire() and release() are quicker than a with block.)
+        lock = self.lock
+        lock.acquire()
+        try:
+            link = self.links.get(arg)
+            if link is not None:
+                # Move to the most recently used end.
+                link_prev, link_next, arg, result = link
+                link_prev[1] = link_next
+                link_next[0] = link_prev
+                root = self.root
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                return result
+        finally:
+            lock.release()
+        result = self.func(arg)
+        with self.lock:
+            if arg in self.links:
+                # Another thread got there first.
+                return result
+            root = self.root
+            if len(self.links) >= self.size:
+                # Reuse the least recently used link.
+                oldest = root[1]
+                del self.links[oldest[2]]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+            last = root[0]
+            link = [last, root, arg, result]
+            last[1] = root[0] = self.links[arg] = link
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.links.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+
 delchars = ''.join(c for c in map(chr, xrange(256)) if not c.isalnum())
+nonalnum_re = re.compile(r'[\W_]+', re.UNICODE)
+
+class KeyNormaliser(LRUMemo):
+    """ Compiled, memoised, alnum() for a given set of 'strip' strings.
+
+        Byte strings are stripped with the 'delchars' table (which is quicker
+        than memoising them), and unicode with a regex, so non-ASCII letters
+        are kept. batch() normalises a whole column of keys.
+    """
+    def __init__(self, strip=(), cache_size=1024):
+        LRUMemo.__init__(self, self.normalise, cache_size)
+        self.strip = tuple(strip)
+        self.strip_re = (re.compile('|'.join(map(re.escape, self.strip)))
+                            if self.strip else None)
+
+    def __call__(self, k):
+        # Byte strings are quicker to translate than to look up.
+        if type(k) is str:
+            k = k.lower()
+            for s in self.strip:
+                k = k.replace(s, '')
+            return k.translate(None, delchars)
+        try:
+            hash(k)
+        except TypeError:
+            # Unhashable, e.g. a list, so can't be memoised.
+            return self.normalise(k)
+        return LRUMemo.__call__(self, k)
+
+    def normalise(self, k):
+        if not isinstance(k, basestring):
+            k = str(k)
+        k = k.lower()
+        if self.strip_re:
+            k = self.strip_re.sub('', k)
+        if isinstance(k, unicode):
+            return nonalnum_re.sub('', k)
+        return k.translate(None, delchars)
+
+    def batch(self, keys):
+        return map(self, keys)
+
+
+_normalisers = {}
 def alnum(k, *args):
     """ Strips everything but alpha numeric chars to give a nice dict key str.
         Any extra arguments given are also removed from the string.
     """
-    k = str(k).lower()
-    for arg in args:
-        k = k.replace(arg, '')
-    return k.translate(None, delchars)
+    if type(k) is str:
+        k = k.lower()
+        for arg in args:
+            k = k.replace(arg, '')
+        return k.translate(None, delchars)
+    # Anything else (i.e. unicode) is normalised, and memoised, by a
+    # KeyNormaliser per set of args.
+    normaliser = _normalisers.get(args)
+    if normaliser is None:
+        normaliser = _normalisers[args] = KeyNormaliser(args)
+    return normaliser(k)
 
 # Keep compatability
 key = alnum
 
-def unkey(k, key_type=None, sep=' ', case='lower', keywords=[]):
+
+class Unkeyer(LRUMemo):
+    """ Compiled, memoised, reverse of a KeyNormaliser: splits keys on the
+        given 'keywords' with 'sep', and gives them 'case' case.
+    """
+    def __init__(self, keywords=(), sep=' ', case='lower', cache_size=1024):
+        LRUMemo.__init__(self, self.unkey, cache_size)
+        self.sep = sep
+        self.case = case
+        # Longest first, so keywords containing others take precedence.
+        keywords = sorted(set(kw for kw in keywords if kw), key=len,
+                          reverse=True)
+        self.keywords_re = (re.compile('|'.join(map(re.escape, keywords)))
+                                if keywords else None)
+        self.seps_re = re.compile('(?:{0})+'.format(re.escape(sep))
+                                    if sep else '(?!)')
+
+    def unkey(self, k):
+        if self.keywords_re:
+            k = self.keywords_re.sub(lambda m: self.sep + m.group() + self.sep,
+                                     k)
+            k = self.seps_re.sub(self.sep, k).strip(self.sep)
+        return getattr(k, self.case)()
+
+
+_unkeyers = {}
+def unkey(k, key_type=None, sep=' ', case='lower', keywords=()):
     """ Attempts to reconstruct a str that has been 'key()'ed.
     """
     # Populate keywords to split on
-    keywords += [__package__.__name__, 'name', 'type', 'str']
+    keywords = list(keywords) + [__package__, 'name', 'type', 'str']
     # if we can use preset defaults
     if key_type == 'sentence':
         sep = ' '
@@ -75,11 +217,13 @@ def unkey(k, key_type=None, sep=' ', case='lower', keywords=[]):
         sep = '-'
         case = 'title'
         keywords += ['accept', 'url', 'agent']
-    # Insert 'sep' between 'keywords'
-    for kw in keywords:
-        k.replace(kw, sep + kw + sep)
-    # return it with 'case' case
-    return getattr(k, case)()
+    args = (tuple(keywords), sep, case)
+    try:
+        unkeyer = _unkeyers[args]
+    except KeyError:
+        unkeyer = _unkeyers[args] = Unkeyer(*args)
+    # Insert 'sep' between 'keywords', with 'case' case
+    return unkeyer(k)
 
 
 def display_TraceBack(logger=logging.getLogger('TB'), level='error'):
@@ -116,26 +260,260 @@ def retry_open(fl, *args, **kwargs):
 
 
 def retry_urlopen(url, attempts=50, *args, **kwargs):
-    """ Keep retrying the connection in-case the network's down.
+    """ Keep retrying the connection in-case the network's down, sleeping
+        fetch.backoff(attempt, 'backoff', 'max_backoff') between attempts.
+        Only connection errors and 5xx responses are retried; other HTTP
+        errors are raised straight away. If a 'reauth' function is given
+        it's called with the error on a 590 (or 401) response, to get a new
+        cookie or similar. GETs go through the 'cache' (a
+        cache.ResponseCache) if given, keyed on the URL and any
+        Authorization and Cookie headers of a Request 'url' (but not cookies
+        added by the installed opener). (For lots of URLs use a
+        fetch.Fetcher, which also reuses connections.)
     """
+    reauth = kwargs.pop('reauth', None)
+    base = kwargs.pop('backoff', 0.5)
+    cap = kwargs.pop('max_backoff', 30.0)
+    cache = kwargs.pop('cache', None)
+    if (cache is None or
+            (args[0] if args else kwargs.get('data')) is not None or
+            isinstance(url, urllib2.Request) and url.has_data()):
+        return _retry_urlopen(url, attempts, reauth, base, cap, args, kwargs)
+
+    if isinstance(url, urllib2.Request):
+        full_url = url.get_full_url()
+        headers = dict(url.unredirected_hdrs, **url.headers)
+    else:
+        full_url, headers = url, {}
+
+    def request(validators):
+        conditional = urllib2.Request(full_url, headers=headers)
+        for item in validators.iteritems():
+            conditional.add_header(*item)
+        try:
+            responce = _retry_urlopen(conditional, attempts, reauth, base,
+                                      cap, args, kwargs)
+        except urllib2.HTTPError as ex:
+            if ex.code != 304:
+                raise
+            return 304, {}, ''
+        return responce.getcode(), dict(responce.info()), responce.read()
+
+    entry = cache.fetch(cache.key(full_url, *cache.identity(headers)),
+                        full_url, request)
+    headers = ''.join('{0}: {1}\r\n'.format(*item)
+                      for item in entry.headers.iteritems())
+    return urllib.addinfourl(StringIO(entry.body),
+                             mimetools.Message(StringIO(headers)),
+                             entry.url, entry.status)
+
+def _retry_urlopen(url, attempts, reauth, base, cap, args, kwargs):
     for attempt in range(attempts):
         try:
             return urllib2.urlopen(url, *args, **kwargs)
         except urllib2.URLError as ex:
+            code = getattr(ex, 'code', None)
+            if reauth and code in (401, 590):
+                log.error("Caught {0} in GetPage, getting new cookie."
+                            .format(ex))
+                reauth(ex)
+                continue
+            # Only connection errors and server errors are worth retrying,
+            # anything else (404, 403, 304, ...) won't change.
+            if code is not None and code < 500:
+                raise
             log.error("Caught {0} in GetPage, retry number {1}."
                         .format(ex, attempt))
-            if "590" in str(ex):
-                log.error("Getting new cookie")
-                GetCookie()
-            continue
+        if attempt + 1 < attempts:
+            time.sleep(backoff(attempt, base, cap))
 
     log.error("Retried {0} times with no valid response.".format(attempts))
     raise urllib2.URLError("Open retried {0} times!".format(attempts))
 
 
-html_tag_re = re.compile(r'<.*?>')
-def strip_html(data):
-    return html_tag_re.sub('', data)
+# Markup to strip: comments, CDATA sections, script and style elements, and
+# tags (with attribute values quoted after an '='). Each alternative can also
+# run to the end of the data, to find markup that's incomplete (so far).
+html_markup_re = re.compile(r"""
+    <!--.*?(?:(?P<comment_end>-->)|\Z)
+  | <!\[CDATA\[(?P<cdata>.*?)(?:(?P<cdata_end>\]\]>)|\Z)
+  | <(?P<skip>script|style)\b.*?(?:(?P<skip_end></(?P=skip)\s*>)|\Z)
+  | (?P<tag><)(?:[a-zA-Z/!?]
+        (?:[^>=]+|=\s*"[^"]*"|=\s*'[^']*'|=(?!\s*["']))*
+        (?:=\s*"[^"]*|=\s*'[^']*)?)?
+        (?:(?P<tag_end>>)|\Z)
+""", re.S | re.I | re.X)
+# The html_markup_re groups that end closed markup.
+html_markup_ends = frozenset(('comment_end', 'cdata_end', 'skip_end',
+                              'tag_end'))
+html_entity_re = re.compile(r'&(?:#([xX][0-9a-fA-F]+|[0-9]+)|(\w+));')
+html_partial_entity_re = re.compile(r'&[#\w]{0,32}\Z')
+# The ends of the comment and CDATA markup, and of each skipped element.
+html_comment_end_re = re.compile(r'-->')
+html_cdata_end_re = re.compile(r'\]\]>')
+html_skip_end_res = {}
+
+class HtmlStripper(object):
+    """ Incremental HTML tag stripper.
+
+        feed() it chunks of a document as they arrive, and it returns the
+        text found so far, with entities decoded (and encoded with 'encoding'
+        if the chunks are byte strings); close() returns what's left. Tags,
+        comments, declarations and script and style elements are dropped,
+        CDATA sections are kept as text. Only markup (or an entity) split
+        across chunks is buffered; while a comment, CDATA section or script
+        or style element is open only new data is searched for it's end.
+        A tag that isn't closed within 'max_tag' characters (e.g. a stray
+        '<', or an unbalanced quote) is kept as text instead.
+    """
+    max_tag = 1 << 16
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.buffer = ''
+        # The markup open at the start of the buffer, as (end regex, whether
+        # it's content is kept, where it's content starts, where to resume
+        # searching for it's end), or None.
+        self.open = None
+
+    def _entity(self, match):
+        ref, name = match.groups()
+        try:
+            if ref:
+                char = unichr(int(ref[1:], 16) if ref[0] in 'xX'
+                              else int(ref))
+            else:
+                char = unichr(name2codepoint[name])
+        except (KeyError, ValueError, OverflowError):
+            return match.group()
+        return char if self.unicode else char.encode(self.encoding)
+
+    def _text(self, text):
+        if '&' in text:
+            return html_entity_re.sub(self._entity, text)
+        return text
+
+    def _open(self, match):
+        """ Sets 'open' for the incomplete 'match' at the start of the
+            buffer, if it's markup that can run on.
+        """
+        markup = match.group()
+        if markup.startswith('<!--'):
+            self.open = (html_comment_end_re, False, 4)
+        elif match.group('cdata') is not None:
+            self.open = (html_cdata_end_re, True, 9)
+        elif match.group('skip'):
+            skip = match.group('skip').lower()
+            end_re = html_skip_end_res.get(skip)
+            if end_re is None:
+                end_re = html_skip_end_res[skip] = re.compile(
+                                r'</{0}\s*>'.format(skip), re.I)
+            self.open = (end_re, False, len(skip) + 1)
+        else:
+            return
+        self.open += (self._resume(self.open[0], self.open[2]),)
+
+    def _resume(self, end_re, start):
+        """ Returns where to resume searching for 'end_re' once more data's
+            been added, having searched the buffer from 'start'.
+        """
+        if end_re.pattern.startswith('<'):
+            # An end tag split across chunks starts at the last '<' (if it's
+            # not padded with more than a line of whitespace).
+            pos = self.buffer.rfind('<', max(start, len(self.buffer) - 80))
+            return len(self.buffer) if pos < 0 else pos
+        return max(start, len(self.buffer) - 2)
+
+    def _continue(self, final):
+        """ Searches the new data for the end of the 'open' markup, returns
+            it's text if it ends (or it's the 'final' data), else None.
+        """
+        end_re, keep, content, resume = self.open
+        match = end_re.search(self.buffer, resume)
+        if match:
+            text = self.buffer[content:match.start()] if keep else ''
+            self.buffer = self.buffer[match.end():]
+        elif final:
+            text = self.buffer[content:] if keep else ''
+            self.buffer = ''
+        else:
+            self.open = (end_re, keep, content,
+                         self._resume(end_re, resume))
+            return None
+        self.open = None
+        return text
+
+    def _strip(self, final=False):
+        text = []
+        if self.open:
+            markup = self._continue(final)
+            if markup is None:
+                return ''
+            text.append(markup)
+        data, pos, scan = self.buffer, 0, 0
+        end = len(data)
+        search = html_markup_re.search
+        while True:
+            match = search(data, scan)
+            if match is None:
+                break
+            # The last group matched says which markup, and if it's closed.
+            last = match.lastgroup
+            if last == 'tag' and match.end() - match.start() > self.max_tag:
+                # An unclosed tag this long isn't one; keep the '<' as text.
+                scan = match.start() + 1
+                continue
+            if (not final and last not in html_markup_ends and
+                    match.end() == end):
+                # Incomplete, so wait for more.
+                end = match.start()
+                break
+            text.append(self._text(data[pos:match.start()]))
+            if last in ('cdata', 'cdata_end'):
+                text.append(match.group('cdata'))
+            pos = scan = match.end()
+        if not final:
+            partial = html_partial_entity_re.search(data, pos, end)
+            if partial:
+                end = partial.start()
+        text.append(self._text(data[pos:end]))
+        self.buffer = data[end:]
+        if match is not None:
+            self._open(match)
+        return ''.join(text)
+
+    def feed(self, data):
+        """ Parses another chunk, returns the text found so far.
+        """
+        self.unicode = isinstance(data, unicode)
+        self.buffer += data
+        return self._strip()
+
+    def close(self):
+        """ Finishes parsing, returns the remaining text.
+        """
+        self.unicode = isinstance(self.buffer, unicode)
+        return self._strip(final=True)
+
+
+def iter_strip_html(chunks, encoding='utf-8'):
+    """ Generates the text of an HTML document from it's 'chunks' (e.g.
+        iter(lambda: response.read(1 << 16), '')) as they're parsed.
+    """
+    stripper = HtmlStripper(encoding)
+    for chunk in chunks:
+        text = stripper.feed(chunk)
+        if text:
+            yield text
+    text = stripper.close()
+    if text:
+        yield text
+
+
+def strip_html(data, encoding='utf-8'):
+    """ Returns the text of HTML 'data'; see HtmlStripper.
+    """
+    return ''.join(iter_strip_html((data,), encoding))
 
 if __name__ == '__main__':
     sys.stderr.write('\n'.join((__doc__, 'import only.', '')))